@@ -13,9 +13,96 @@ Pattern Benefits:
 NOTE: This is a sanitized example showing the pattern, not production code.
 """
 
-from anthropic import Anthropic
+from anthropic import (
+    Anthropic,
+    AsyncAnthropic,
+    DefaultHttpxClient,
+    DefaultAsyncHttpxClient,
+    DEFAULT_CONNECTION_LIMITS,
+)
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
+import asyncio
+import functools
 import json
+import threading
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # optional: routing falls back to the Claude API
+    SentenceTransformer = None
+
+
+# Shared clients, created on first use and reused by every agent so that
+# connections (and their TLS sessions) are pooled instead of rebuilt per call.
+# Limits is built from the type of the SDK's own default, so it matches the
+# httpx flavour (httpx or httpx2) that the installed SDK is built on.
+HTTP_LIMITS = type(DEFAULT_CONNECTION_LIMITS)(max_connections=64, max_keepalive_connections=32)
+
+_client: Optional[Anthropic] = None
+_async_client: Optional[AsyncAnthropic] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+ROUTING_CACHE_SIZE = 1024
+
+# Local embedding routing: accept the nearest agent role only when it is
+# similar enough to the task and clearly ahead of the runner-up.
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+ROUTING_MIN_SIMILARITY = 0.35
+ROUTING_MIN_MARGIN = 0.05
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    """Return the shared sentence-transformers model, or None if not installed."""
+    global _embedder
+    if _embedder is None and SentenceTransformer is not None:
+        # Routing may run in worker threads; load the model only once
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = SentenceTransformer(EMBEDDING_MODEL)
+    return _embedder
+
+
+def get_client() -> Anthropic:
+    """Return the shared sync Anthropic client, creating it if needed."""
+    global _client
+    if _client is None:
+        _client = Anthropic(http_client=DefaultHttpxClient(limits=HTTP_LIMITS))
+    return _client
+
+
+def get_async_client() -> AsyncAnthropic:
+    """
+    Return the shared AsyncAnthropic client, creating it if needed.
+
+    Async connections are bound to the event loop that opened them, so the
+    client is rebuilt when called from a different loop. Code that owns a
+    short-lived loop should call close_async_client() before it exits.
+    """
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = AsyncAnthropic(http_client=DefaultAsyncHttpxClient(limits=HTTP_LIMITS))
+        _async_client_loop = loop
+    return _async_client
+
+
+async def close_async_client():
+    """Close the shared AsyncAnthropic client if it belongs to the running loop."""
+    global _async_client, _async_client_loop
+    if _async_client is not None and _async_client_loop is asyncio.get_running_loop():
+        client = _async_client
+        _async_client = None
+        _async_client_loop = None
+        await client.close()
+
+
+class _UnknownAgent(Exception):
+    """Routing named an agent that does not exist."""
 
 
 class SubAgent:
@@ -26,6 +113,10 @@ class SubAgent:
     - name: Unique identifier
     - role: Description of responsibilities
     - tools: List of tool definitions for this agent
+
+    Clients default to the shared pooled ones; pass client/async_client
+    to inject your own (e.g. a fake in tests). execute() uses client and
+    execute_async() (and so pipelines) uses async_client when given.
     """
 
     def __init__(
@@ -33,13 +124,31 @@ class SubAgent:
         name: str,
         role: str,
         tools: List[Dict[str, Any]],
-        system_prompt: Optional[str] = None
+        system_prompt: Optional[str] = None,
+        client: Optional[Anthropic] = None,
+        async_client: Optional[AsyncAnthropic] = None
     ):
         self.name = name
         self.role = role
         self.tools = tools
         self.system_prompt = system_prompt or f"You are a {role}."
-        self.client = Anthropic()
+        self._client = client
+        self._async_client = async_client
+
+    @property
+    def client(self) -> Anthropic:
+        return self._client if self._client is not None else get_client()
+
+    @property
+    def async_client(self) -> AsyncAnthropic:
+        return self._async_client if self._async_client is not None else get_async_client()
+
+    def _build_system_prompt(self, context: Optional[Dict] = None) -> str:
+        """Append serialized context (if any) to the agent's system prompt."""
+        if context:
+            context_str = json.dumps(context, indent=2)
+            return f"{self.system_prompt}\n\nContext:\n{context_str}"
+        return self.system_prompt
 
     def execute(self, task: str, context: Optional[Dict] = None) -> Dict[str, Any]:
         """
@@ -53,13 +162,7 @@ class SubAgent:
             Dictionary with result and metadata
         """
         messages = [{"role": "user", "content": task}]
-
-        if context:
-            # Add context to system prompt
-            context_str = json.dumps(context, indent=2)
-            enhanced_prompt = f"{self.system_prompt}\n\nContext:\n{context_str}"
-        else:
-            enhanced_prompt = self.system_prompt
+        enhanced_prompt = self._build_system_prompt(context)
 
         try:
             response = self.client.messages.create(
@@ -84,6 +187,45 @@ class SubAgent:
                 "error": str(e)
             }
 
+    async def execute_async(self, task: str, context: Optional[Dict] = None) -> Dict[str, Any]:
+        """
+        Async variant of execute() using AsyncAnthropic.
+
+        Lets independent tasks overlap their API round-trips on one event loop.
+        Agents with an injected sync client (and no async_client), or whose
+        subclass overrides execute(), run execute() in a worker thread instead
+        so the pipeline honours them.
+        """
+        if (self._client is not None and self._async_client is None) or \
+                type(self).execute is not SubAgent.execute:
+            return await asyncio.to_thread(self.execute, task, context)
+
+        messages = [{"role": "user", "content": task}]
+        enhanced_prompt = self._build_system_prompt(context)
+
+        try:
+            response = await self.async_client.messages.create(
+                model="claude-sonnet-4",
+                max_tokens=4096,
+                system=enhanced_prompt,
+                messages=messages,
+                tools=self.tools
+            )
+
+            return {
+                "success": True,
+                "agent": self.name,
+                "result": response.content,
+                "usage": response.usage
+            }
+
+        except Exception as e:
+            return {
+                "success": False,
+                "agent": self.name,
+                "error": str(e)
+            }
+
 
 class AgentOrchestrator:
     """
@@ -96,20 +238,104 @@ class AgentOrchestrator:
     - Handle failures and retries
     """
 
-    def __init__(self, subagents: List[SubAgent]):
+    def __init__(
+        self,
+        subagents: List[SubAgent],
+        cache_routing: bool = True,
+        client: Optional[Anthropic] = None,
+        history_limit: int = 10_000,
+        use_embeddings: bool = False,
+        embedder=None
+    ):
         self.subagents = {agent.name: agent for agent in subagents}
-        self.client = Anthropic()
-        self.execution_history = []
+        # Bounded so long-running services don't grow history forever
+        self.execution_history = deque(maxlen=history_limit)
+        self._client = client
+        # Local routing is opt-in: the shared model is loaded (and possibly
+        # downloaded) on first use. Passing an embedder also enables it.
+        self._use_embeddings = use_embeddings or embedder is not None
+        self._embedder = embedder
+        self._role_embeddings: Dict[tuple, Any] = {}
+
+        # Routing is a function of the task text and the agent roster, so
+        # repeated tasks can skip the API round-trip. maxsize=0 disables it.
+        cache_size = ROUTING_CACHE_SIZE if cache_routing else 0
+        self._route_cached = functools.lru_cache(maxsize=cache_size)(self._route_uncached)
+
+    @property
+    def client(self) -> Anthropic:
+        """Client used for routing; the shared pooled one unless injected."""
+        return self._client if self._client is not None else get_client()
+
+    @property
+    def embedder(self):
+        """
+        Embedding model for local routing.
+
+        The injected embedder if any, else the shared model when
+        use_embeddings is set. None (local routing off, or
+        sentence-transformers not installed) means always ask Claude.
+        """
+        if not self._use_embeddings:
+            return None
+        return self._embedder if self._embedder is not None else get_embedder()
 
     def route_task(self, task: str) -> str:
         """
         Determine which subagent should handle the task.
 
-        Uses Claude to analyze the task and select the best agent.
+        With local routing enabled, matches the task against agent roles
+        by embedding similarity and asks Claude only when that match is
+        ambiguous. Otherwise uses Claude to select the best agent.
+
+        Decisions are memoized per (task, agents) pair. If Claude names an
+        unknown agent, the first agent is used and nothing is cached.
         """
+        agent_key = tuple(sorted(
+            (name, agent.role) for name, agent in self.subagents.items()
+        ))
+        try:
+            return self._route_cached(task, agent_key)
+        except _UnknownAgent:
+            # Fallback to first agent if routing fails
+            return next(iter(self.subagents))
+
+    def routing_cache_info(self):
+        """Return hit/miss statistics for the routing cache."""
+        return self._route_cached.cache_info()
+
+    def _route_by_embedding(self, task: str, agent_key: tuple) -> Optional[str]:
+        """Return the agent whose role is nearest the task, or None if unsure."""
+        embedder = self.embedder
+        if embedder is None:
+            return None
+
+        if agent_key not in self._role_embeddings:
+            self._role_embeddings[agent_key] = embedder.encode(
+                [role for _, role in agent_key], normalize_embeddings=True
+            )
+        role_embeddings = self._role_embeddings[agent_key]
+        query = embedder.encode([task], normalize_embeddings=True)[0]
+
+        # Cosine similarity (vectors are normalized)
+        scores = role_embeddings @ query
+        ranked = scores.argsort()
+        best_score = float(scores[ranked[-1]])
+        runner_up = float(scores[ranked[-2]]) if len(ranked) > 1 else -1.0
+
+        if best_score < ROUTING_MIN_SIMILARITY or best_score - runner_up < ROUTING_MIN_MARGIN:
+            return None
+        return agent_key[int(ranked[-1])][0]
+
+    def _route_uncached(self, task: str, agent_key: tuple) -> str:
+        """Pick an agent locally if confident, otherwise ask Claude."""
+        agent_name = self._route_by_embedding(task, agent_key)
+        if agent_name is not None:
+            return agent_name
+
         agent_descriptions = "\n".join([
-            f"- {name}: {agent.role}"
-            for name, agent in self.subagents.items()
+            f"- {name}: {role}"
+            for name, role in agent_key
         ])
 
         routing_prompt = f"""
@@ -131,10 +357,9 @@ class AgentOrchestrator:
 
         agent_name = response.content[0].text.strip()
 
-        # Validate agent exists
+        # Validate agent exists; raising keeps the miss out of the cache
         if agent_name not in self.subagents:
-            # Fallback to first agent if routing fails
-            agent_name = list(self.subagents.keys())[0]
+            raise _UnknownAgent(agent_name)
 
         return agent_name
 
@@ -155,17 +380,43 @@ class AgentOrchestrator:
         Returns:
             Result dictionary with agent output and metadata
         """
-        # Route to agent
+        agent_name = self._select_agent(task, preferred_agent)
+
+        # Execute with selected agent
+        agent = self.subagents[agent_name]
+        result = agent.execute(task, context)
+
+        self._record(task, agent_name, result)
+        return result
+
+    async def execute_async(
+        self,
+        task: str,
+        preferred_agent: Optional[str] = None,
+        context: Optional[Dict] = None
+    ) -> Dict[str, Any]:
+        """
+        Async variant of execute(). Routing stays sync and runs in a thread.
+        """
         if preferred_agent and preferred_agent in self.subagents:
             agent_name = preferred_agent
         else:
-            agent_name = self.route_task(task)
+            agent_name = await asyncio.to_thread(self.route_task, task)
 
-        # Execute with selected agent
         agent = self.subagents[agent_name]
-        result = agent.execute(task, context)
+        result = await agent.execute_async(task, context)
+
+        self._record(task, agent_name, result)
+        return result
+
+    def _select_agent(self, task: str, preferred_agent: Optional[str]) -> str:
+        """Use the preferred agent if it exists, otherwise route automatically."""
+        if preferred_agent and preferred_agent in self.subagents:
+            return preferred_agent
+        return self.route_task(task)
 
-        # Track execution
+    def _record(self, task: str, agent_name: str, result: Dict[str, Any]):
+        """Track execution."""
         self.execution_history.append({
             "task": task,
             "agent": agent_name,
@@ -173,34 +424,132 @@ class AgentOrchestrator:
             "timestamp": None  # Add timestamp in production
         })
 
-        return result
+    @staticmethod
+    def _pipeline_layers(tasks: List[Dict[str, Any]]) -> List[List[int]]:
+        """
+        Group task indices into layers that can run concurrently.
 
-    def execute_pipeline(self, tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        A task's id is its 'id' key, or 'task_N' (1-based) by default, and
+        'depends_on' lists the ids it must wait for. Tasks without
+        dependencies land in the first layer.
+
+        Raises:
+            ValueError: On duplicate task ids, unknown dependency ids or
+                dependency cycles
+        """
+        ids = [task.get("id", f"task_{i}") for i, task in enumerate(tasks, 1)]
+        index_of = {}
+        for i, task_id in enumerate(ids):
+            if task_id in index_of:
+                raise ValueError(f"Duplicate pipeline task id '{task_id}'")
+            index_of[task_id] = i
+
+        remaining = {}
+        for i, task in enumerate(tasks):
+            deps = set()
+            for dep in task.get("depends_on", []):
+                if dep not in index_of:
+                    raise ValueError(f"Task '{ids[i]}' depends on unknown task '{dep}'")
+                deps.add(index_of[dep])
+            remaining[i] = deps
+
+        layers = []
+        done = set()
+        while remaining:
+            layer = [i for i, deps in remaining.items() if deps <= done]
+            if not layer:
+                raise ValueError("Pipeline tasks contain a dependency cycle")
+            layers.append(layer)
+            done.update(layer)
+            for i in layer:
+                del remaining[i]
+
+        return layers
+
+    async def execute_pipeline_async(self, tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
-        Execute multiple tasks in sequence, passing context between them.
+        Execute a pipeline, running independent tasks concurrently.
 
-        Each task can reference results from previous tasks.
+        Each layer of the dependency graph is dispatched with asyncio.gather,
+        so wall-clock time scales with pipeline depth rather than task count.
+        Every task sees the results of all tasks finished in earlier layers.
 
         Args:
-            tasks: List of task dictionaries with 'description' and optional 'agent'
+            tasks: List of task dictionaries with 'description' and optional
+                'agent', 'id' and 'depends_on'
 
         Returns:
-            List of results from each task
+            List of results in the same order as tasks
         """
-        results = []
+        results: List[Optional[Dict[str, Any]]] = [None] * len(tasks)
         context = {}
 
-        for task_config in tasks:
-            task = task_config["description"]
-            preferred_agent = task_config.get("agent")
+        for layer in self._pipeline_layers(tasks):
+            # Snapshot so tasks in the same layer share identical context
+            layer_context = dict(context)
+            layer_results = await asyncio.gather(*[
+                self.execute_async(
+                    tasks[i]["description"],
+                    tasks[i].get("agent"),
+                    layer_context
+                )
+                for i in layer
+            ])
+
+            for i, result in zip(layer, layer_results):
+                results[i] = result
+                if result["success"]:
+                    context[tasks[i].get("id", f"task_{i + 1}")] = result["result"]
+
+        return results
 
-            # Execute with accumulated context
-            result = self.execute(task, preferred_agent, context)
-            results.append(result)
+    async def _execute_pipeline_in_new_loop(self, tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Run a pipeline on a throwaway loop, closing the async client it opened."""
+        try:
+            return await self.execute_pipeline_async(tasks)
+        finally:
+            await close_async_client()
+
+    def execute_pipeline(self, tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Execute multiple tasks, passing context between dependent steps.
+
+        Sync wrapper around execute_pipeline_async(). When called from inside
+        a running event loop, falls back to a thread pool per layer instead.
+
+        Args:
+            tasks: List of task dictionaries with 'description' and optional
+                'agent', 'id' and 'depends_on'
+
+        Returns:
+            List of results from each task
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._execute_pipeline_in_new_loop(tasks))
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(tasks)
+        context = {}
 
-            # Update context for next task
-            if result["success"]:
-                context[f"task_{len(results)}"] = result["result"]
+        with ThreadPoolExecutor() as pool:
+            for layer in self._pipeline_layers(tasks):
+                layer_context = dict(context)
+                futures = [
+                    pool.submit(
+                        self.execute,
+                        tasks[i]["description"],
+                        tasks[i].get("agent"),
+                        layer_context
+                    )
+                    for i in layer
+                ]
+
+                for i, future in zip(layer, futures):
+                    result = future.result()
+                    results[i] = result
+                    if result["success"]:
+                        context[tasks[i].get("id", f"task_{i + 1}")] = result["result"]
 
         return results
 
@@ -311,11 +660,13 @@ def example_grant_research_system():
         },
         {
             "description": "Check eligibility for the top 3 grants found",
-            "agent": "eligibility_checker"
+            "agent": "eligibility_checker",
+            "depends_on": ["task_1"]
         },
         {
             "description": "Generate application for the most suitable grant",
-            "agent": "documentation_writer"
+            "agent": "documentation_writer",
+            "depends_on": ["task_2"]
         }
     ]
 
@@ -16,13 +16,19 @@ NOTE: This is a sanitized example showing the pattern, not production code.
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from anthropic import Anthropic
+from anthropic import Anthropic, AsyncAnthropic
 import json
 import asyncio
-from typing import Dict, Any, Optional
-from datetime import datetime
+from collections.abc import MutableMapping
+from typing import Dict, Any, Iterator, List, Optional
+from datetime import date, datetime, time
 import logging
 
+try:
+    import orjson
+except ImportError:  # optional speedup; fall back to the stdlib encoder
+    orjson = None
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -38,8 +44,69 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize Anthropic client
+# Initialize Anthropic clients (async for text streaming, so reading the
+# stream never blocks the event loop)
 client = Anthropic()
+async_client = AsyncAnthropic()
+
+
+def _json_default(obj: Any) -> str:
+    """Encode datetimes as ISO 8601, as orjson does natively."""
+    if isinstance(obj, (date, time)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def encode_message(message: Dict[str, Any]) -> str:
+    """
+    Serialize a message to compact JSON, using orjson when available.
+
+    Both paths produce the same output: non-string keys are converted to
+    strings and datetimes to ISO 8601.
+    """
+    if orjson is not None:
+        return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(
+        message, separators=(",", ":"), ensure_ascii=False, default=_json_default
+    )
+
+
+class _ShardedConnections(MutableMapping):
+    """
+    Dict-like store of WebSocket connections split across shards.
+
+    Each client_id lives in shard hash(client_id) % num_shards, so lookups
+    and mutations only touch one small dict.
+    """
+
+    def __init__(self, num_shards: int = 16):
+        self.shards: List[Dict[str, WebSocket]] = [{} for _ in range(num_shards)]
+
+    def shard_for(self, client_id: str) -> Dict[str, WebSocket]:
+        return self.shards[hash(client_id) % len(self.shards)]
+
+    def __getitem__(self, client_id: str) -> WebSocket:
+        return self.shard_for(client_id)[client_id]
+
+    def __setitem__(self, client_id: str, websocket: WebSocket):
+        self.shard_for(client_id)[client_id] = websocket
+
+    def __delitem__(self, client_id: str):
+        del self.shard_for(client_id)[client_id]
+
+    def __contains__(self, client_id: object) -> bool:
+        return client_id in self.shard_for(client_id)
+
+    def __iter__(self) -> Iterator[str]:
+        for shard in self.shards:
+            yield from shard
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
 
 
 class ConnectionManager:
@@ -52,8 +119,24 @@ class ConnectionManager:
     - Handle disconnections
     """
 
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+    def __init__(self, num_shards: int = 16, send_timeout: float = 0.5):
+        self._connections = _ShardedConnections(num_shards)
+        self.send_timeout = send_timeout
+
+    @property
+    def active_connections(self) -> _ShardedConnections:
+        """Mapping of client_id -> WebSocket across all shards."""
+        return self._connections
+
+    @active_connections.setter
+    def active_connections(self, connections: Dict[str, WebSocket]):
+        # Snapshot first: connections may be a view over this same store
+        snapshot = dict(connections)
+        self._connections.clear()
+        self._connections.update(snapshot)
+
+    def __len__(self) -> int:
+        return len(self._connections)
 
     async def connect(self, websocket: WebSocket, client_id: str):
         """Accept and register new connection."""
@@ -61,31 +144,74 @@ class ConnectionManager:
         self.active_connections[client_id] = websocket
         logger.info(f"Client {client_id} connected. Total connections: {len(self.active_connections)}")
 
-    def disconnect(self, client_id: str):
-        """Remove connection."""
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
+    def disconnect(self, client_id: str, websocket: Optional[WebSocket] = None):
+        """Remove connection (only if it is still websocket, when given)."""
+        shard = self._connections.shard_for(client_id)
+        if client_id in shard and (websocket is None or shard[client_id] is websocket):
+            del shard[client_id]
             logger.info(f"Client {client_id} disconnected. Total connections: {len(self.active_connections)}")
 
     async def send_message(self, client_id: str, message: Dict[str, Any]):
         """Send JSON message to specific client."""
-        if client_id in self.active_connections:
-            websocket = self.active_connections[client_id]
-            await websocket.send_json(message)
+        websocket = self._connections.shard_for(client_id).get(client_id)
+        if websocket is not None:
+            await websocket.send_text(encode_message(message))
 
     async def broadcast(self, message: Dict[str, Any]):
-        """Send message to all connected clients."""
-        disconnected = []
-        for client_id, websocket in self.active_connections.items():
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to {client_id}: {e}")
-                disconnected.append(client_id)
-
-        # Clean up disconnected clients
-        for client_id in disconnected:
-            self.disconnect(client_id)
+        """
+        Send message to all connected clients concurrently.
+
+        Clients whose send fails, or is still pending after send_timeout
+        seconds, are dropped so one slow peer can't stall the fan-out. A
+        timed-out send may have been cut off mid-frame, so dropped sockets
+        are closed (code 1011) rather than left open but unregistered.
+        """
+        # Encode once and hand the same payload object to every client;
+        # framing is left to the ASGI server, which owns the socket
+        payload = encode_message(message)
+        tasks = {
+            asyncio.create_task(websocket.send_text(payload)): (client_id, websocket)
+            for client_id, websocket in self.active_connections.items()
+        }
+        if not tasks:
+            return
+
+        done, pending = await asyncio.wait(tasks, timeout=self.send_timeout)
+        dropped = []
+
+        # Cancel and drop clients that didn't accept the message in time
+        for task in pending:
+            task.cancel()
+            logger.error(f"Timed out broadcasting to {tasks[task][0]}")
+            dropped.append(tasks[task])
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        # Drop clients whose send failed
+        for task in done:
+            if task.cancelled() or task.exception() is not None:
+                error = "cancelled" if task.cancelled() else task.exception()
+                logger.error(f"Error broadcasting to {tasks[task][0]}: {error}")
+                dropped.append(tasks[task])
+
+        # Match the socket too: the client may have reconnected meanwhile
+        for client_id, websocket in dropped:
+            self.disconnect(client_id, websocket)
+        await self._close_dropped([websocket for _, websocket in dropped])
+
+    async def _close_dropped(self, websockets: List[WebSocket]):
+        """Close sockets dropped from a broadcast, waiting at most send_timeout."""
+        if not websockets:
+            return
+        closing = [
+            asyncio.create_task(websocket.close(code=1011))
+            for websocket in websockets
+        ]
+        _, pending = await asyncio.wait(closing, timeout=self.send_timeout)
+        for task in pending:
+            task.cancel()
+        # Retrieve results so failed closes on dead sockets aren't reported
+        await asyncio.gather(*closing, return_exceptions=True)
 
 
 manager = ConnectionManager()
@@ -158,6 +284,82 @@ async def agent_websocket(websocket: WebSocket, client_id: str):
             pass
 
 
+class _Coalescer:
+    """
+    Buffers streamed text deltas and sends them as fewer, larger frames.
+
+    A frame is sent flush_ms after the first buffered delta (by a timer
+    task) or as soon as the buffer holds max_chars characters, whichever
+    comes first. Each frame is a normal content_delta message, so clients
+    need no changes. A send that fails in the timer is re-raised by the
+    next push() or flush().
+    """
+
+    def __init__(self, websocket: WebSocket, flush_ms: float = 20, max_chars: int = 4096):
+        self.websocket = websocket
+        self.flush_interval = flush_ms / 1000
+        self.max_chars = max_chars
+        self._buffer = []
+        self._size = 0
+        self._timer: Optional[asyncio.Task] = None
+        self._timer_error: Optional[Exception] = None
+        self._send_lock = asyncio.Lock()
+
+    async def push(self, text: str):
+        """Buffer a delta, flushing now if the size threshold is reached."""
+        self._raise_timer_error()
+        self._buffer.append(text)
+        self._size += len(text)
+
+        if self._size >= self.max_chars:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_after_interval())
+
+        # Yield so other connections run between chunks even when the
+        # stream hands over already-buffered text without awaiting
+        await asyncio.sleep(0)
+
+    async def flush(self):
+        """Send any buffered text now, cancelling the pending timer."""
+        self.cancel()
+        self._raise_timer_error()
+        await self._send_buffer()
+
+    def cancel(self):
+        """Drop the pending timer (if it hasn't started sending yet)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    async def _flush_after_interval(self):
+        await asyncio.sleep(self.flush_interval)
+        # Detach before sending so flush()/cancel() never interrupt a write
+        self._timer = None
+        try:
+            await self._send_buffer()
+        except Exception as e:
+            # Nobody awaits the timer, so hand the error to the stream
+            self._timer_error = e
+
+    def _raise_timer_error(self):
+        if self._timer_error is not None:
+            error, self._timer_error = self._timer_error, None
+            raise error
+
+    async def _send_buffer(self):
+        # Serialize sends so timer and explicit flushes keep frame order
+        async with self._send_lock:
+            if not self._buffer:
+                return
+            content = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            await self.websocket.send_text(
+                encode_message({"type": "content_delta", "content": content})
+            )
+
+
 async def stream_agent_response(
     websocket: WebSocket,
     client_id: str,
@@ -173,6 +375,9 @@ async def stream_agent_response(
     - Completion metadata
     - Error handling
     """
+    # Coalesce text deltas into fewer frames instead of one frame per token
+    coalescer = _Coalescer(websocket)
+
     try:
         # Prepare messages
         messages = [{"role": "user", "content": user_message}]
@@ -189,8 +394,9 @@ async def stream_agent_response(
             "timestamp": datetime.utcnow().isoformat()
         })
 
-        # Stream response
-        with client.messages.stream(
+        # Stream response (async client, so other connections keep running
+        # while we wait on the network)
+        async with async_client.messages.stream(
             model="claude-sonnet-4",
             max_tokens=4096,
             system=system_prompt,
@@ -199,18 +405,12 @@ async def stream_agent_response(
         ) as stream:
 
             # Stream text deltas
-            for text in stream.text_stream:
-                await websocket.send_json({
-                    "type": "content_delta",
-                    "content": text
-                })
-
-                # Small delay to prevent overwhelming client
-                # (adjust based on your needs)
-                await asyncio.sleep(0.01)
+            async for text in stream.text_stream:
+                await coalescer.push(text)
+            await coalescer.flush()
 
             # Get final message
-            final_message = stream.get_final_message()
+            final_message = await stream.get_final_message()
 
             # Send completion
             await websocket.send_json({
@@ -224,6 +424,7 @@ async def stream_agent_response(
 
     except Exception as e:
         logger.error(f"Error streaming response for {client_id}: {e}")
+        coalescer.cancel()
         await websocket.send_json({
             "type": "error",
             "error": str(e),
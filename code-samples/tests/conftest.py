@@ -0,0 +1,58 @@
+"""
+Shared pytest configuration for the code sample tests.
+"""
+
+import contextlib
+import sys
+import os
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+# Add parent directory to path for imports (runs once per session)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "leaks_connections: test deliberately leaves WebSocket connections registered",
+    )
+
+
+@contextlib.asynccontextmanager
+async def fake_stream(chunks, usage=(10, 20)):
+    """Stand-in for async_client.messages.stream() yielding canned text chunks."""
+    final_message = SimpleNamespace(
+        usage=SimpleNamespace(input_tokens=usage[0], output_tokens=usage[1])
+    )
+
+    async def text_stream():
+        for chunk in chunks:
+            yield chunk
+
+    async def get_final_message():
+        return final_message
+
+    yield SimpleNamespace(
+        text_stream=text_stream(),
+        get_final_message=get_final_message
+    )
+
+
+@pytest.fixture
+def mock_claude_stream(request):
+    """
+    Patch the streaming sample's async_client.messages.stream with fake_stream.
+
+    Text chunks default to none; override with
+    @pytest.mark.parametrize("mock_claude_stream", [[...]], indirect=True).
+    Yields the patch so tests can inspect the stream call.
+    """
+    chunks = getattr(request, "param", [])
+    with patch(
+        'fastapi_patterns.websocket_streaming.async_client.messages.stream',
+        side_effect=lambda **kwargs: fake_stream(chunks)
+    ) as mock_stream:
+        yield mock_stream
@@ -7,13 +7,12 @@ Production systems should have comprehensive test coverage.
 """
 
 import pytest
-from unittest.mock import Mock, patch, MagicMock
-import sys
-import os
-
-# Add parent directory to path for imports
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from unittest.mock import Mock, patch, MagicMock, AsyncMock
+import asyncio
+import time
+from anthropic import Anthropic, AsyncAnthropic
 
+from claude_agent_sdk import multi_agent_orchestration
 from claude_agent_sdk.multi_agent_orchestration import SubAgent, AgentOrchestrator
 
 
@@ -45,22 +44,19 @@ class TestSubAgent:
 
         assert agent.system_prompt == "You are a grant researcher."
 
-    @patch('claude_agent_sdk.multi_agent_orchestration.Anthropic')
-    def test_execute_success(self, mock_anthropic):
+    def test_execute_success(self, mock_claude_client):
         """Test successful task execution."""
         # Mock Claude API response
         mock_response = Mock()
         mock_response.content = [{"type": "text", "text": "Task completed"}]
         mock_response.usage = Mock(input_tokens=100, output_tokens=50)
-
-        mock_client = Mock()
-        mock_client.messages.create.return_value = mock_response
-        mock_anthropic.return_value = mock_client
+        mock_claude_client.messages.create.return_value = mock_response
 
         agent = SubAgent(
             name="test_agent",
             role="test role",
-            tools=[]
+            tools=[],
+            client=mock_claude_client
         )
 
         result = agent.execute("Test task")
@@ -70,31 +66,40 @@ class TestSubAgent:
         assert "usage" in result
 
     @patch('claude_agent_sdk.multi_agent_orchestration.Anthropic')
-    def test_execute_with_context(self, mock_anthropic):
+    def test_agents_share_client(self, mock_anthropic):
+        """Test that agents without an injected client reuse one pooled client."""
+        mock_client = Mock(spec=Anthropic)
+        mock_client.messages.create.return_value = Mock(content=[], usage=None)
+        mock_anthropic.return_value = mock_client
+
+        agent1 = SubAgent("agent1", "role1", [])
+        agent2 = SubAgent("agent2", "role2", [])
+
+        agent1.execute("Task 1")
+        agent2.execute("Task 2")
+
+        mock_anthropic.assert_called_once()
+        assert mock_client.messages.create.call_count == 2
+
+    def test_execute_with_context(self, mock_claude_client):
         """Test execution with context data."""
         mock_response = Mock()
         mock_response.content = [{"type": "text", "text": "Done"}]
         mock_response.usage = Mock(input_tokens=100, output_tokens=50)
+        mock_claude_client.messages.create.return_value = mock_response
 
-        mock_client = Mock()
-        mock_client.messages.create.return_value = mock_response
-        mock_anthropic.return_value = mock_client
-
-        agent = SubAgent(name="agent", role="role", tools=[])
+        agent = SubAgent(name="agent", role="role", tools=[], client=mock_claude_client)
 
         context = {"user_id": "123", "preferences": {"theme": "dark"}}
         result = agent.execute("Task", context=context)
 
         assert result["success"] is True
 
-    @patch('claude_agent_sdk.multi_agent_orchestration.Anthropic')
-    def test_execute_error_handling(self, mock_anthropic):
+    def test_execute_error_handling(self, mock_claude_client):
         """Test that errors are caught and returned properly."""
-        mock_client = Mock()
-        mock_client.messages.create.side_effect = Exception("API Error")
-        mock_anthropic.return_value = mock_client
+        mock_claude_client.messages.create.side_effect = Exception("API Error")
 
-        agent = SubAgent(name="agent", role="role", tools=[])
+        agent = SubAgent(name="agent", role="role", tools=[], client=mock_claude_client)
 
         result = agent.execute("Task")
 
@@ -117,61 +122,140 @@ class TestAgentOrchestrator:
         assert "agent1" in orchestrator.subagents
         assert "agent2" in orchestrator.subagents
 
-    @patch('claude_agent_sdk.multi_agent_orchestration.Anthropic')
-    def test_route_task(self, mock_anthropic):
+    def test_route_task(self, mock_claude_client):
         """Test task routing to correct agent."""
         # Mock routing response
         mock_response = Mock()
         mock_response.content = [Mock(text="grant_researcher")]
-
-        mock_client = Mock()
-        mock_client.messages.create.return_value = mock_response
-        mock_anthropic.return_value = mock_client
+        mock_claude_client.messages.create.return_value = mock_response
 
         agent1 = SubAgent("grant_researcher", "Research grants", [])
         agent2 = SubAgent("compliance_checker", "Check compliance", [])
 
-        orchestrator = AgentOrchestrator([agent1, agent2])
+        orchestrator = AgentOrchestrator([agent1, agent2], client=mock_claude_client)
 
         agent_name = orchestrator.route_task("Find grants for EV charging")
 
         assert agent_name == "grant_researcher"
 
-    @patch('claude_agent_sdk.multi_agent_orchestration.Anthropic')
-    def test_route_task_fallback(self, mock_anthropic):
+    def test_route_task_fallback(self, mock_claude_client):
         """Test that invalid routing falls back to first agent."""
         # Mock routing response with invalid agent name
         mock_response = Mock()
         mock_response.content = [Mock(text="nonexistent_agent")]
-
-        mock_client = Mock()
-        mock_client.messages.create.return_value = mock_response
-        mock_anthropic.return_value = mock_client
+        mock_claude_client.messages.create.return_value = mock_response
 
         agent1 = SubAgent("agent1", "role1", [])
         agent2 = SubAgent("agent2", "role2", [])
 
-        orchestrator = AgentOrchestrator([agent1, agent2])
+        orchestrator = AgentOrchestrator([agent1, agent2], client=mock_claude_client)
 
         agent_name = orchestrator.route_task("Some task")
 
-        # Should fall back to first agent
+        # Should fall back to first agent, without caching the miss
         assert agent_name == "agent1"
+        assert orchestrator.routing_cache_info().currsize == 0
 
-    @patch('claude_agent_sdk.multi_agent_orchestration.SubAgent.execute')
-    @patch('claude_agent_sdk.multi_agent_orchestration.Anthropic')
-    def test_execute_with_preferred_agent(self, mock_anthropic, mock_execute):
-        """Test execution with preferred agent bypasses routing."""
-        mock_execute.return_value = {
-            "success": True,
-            "agent": "agent2",
-            "result": "Done"
-        }
+    def test_route_task_fallback_not_cached(self, mock_claude_client):
+        """Test that a fallback is not cached, so the task is routed again."""
+        mock_claude_client.messages.create.side_effect = [
+            Mock(content=[Mock(text="nonexistent_agent")]),
+            Mock(content=[Mock(text="agent2")]),
+        ]
 
         agent1 = SubAgent("agent1", "role1", [])
         agent2 = SubAgent("agent2", "role2", [])
 
-        orchestrator = AgentOrchestrator([agent1, agent2])
+        orchestrator = AgentOrchestrator([agent1, agent2], client=mock_claude_client)
+
+        assert orchestrator.route_task("Some task") == "agent1"
+        assert orchestrator.route_task("Some task") == "agent2"
+
+        assert mock_claude_client.messages.create.call_count == 2
+        assert orchestrator.routing_cache_info().currsize == 1
+
+    def test_route_task_cached(self, mock_claude_client):
+        """Test that repeated routing reuses the cached decision."""
+        mock_response = Mock()
+        mock_response.content = [Mock(text="grant_researcher")]
+        mock_claude_client.messages.create.return_value = mock_response
+
+        agent1 = SubAgent("grant_researcher", "Research grants", [])
+        agent2 = SubAgent("compliance_checker", "Check compliance", [])
+
+        orchestrator = AgentOrchestrator([agent1, agent2], client=mock_claude_client)
+
+        assert orchestrator.route_task("Find grants") == "grant_researcher"
+        assert orchestrator.route_task("Find grants") == "grant_researcher"
+
+        assert mock_claude_client.messages.create.call_count == 1
+        assert orchestrator.routing_cache_info().hits == 1
+
+    def test_route_task_local_embedding(self, mock_claude_client):
+        """Test that a confident embedding match skips the Claude API."""
+        np = pytest.importorskip("numpy")
+        vectors = {
+            "Research grants": [1.0, 0.0],
+            "Check compliance": [0.0, 1.0],
+            "Find grants for EV charging": [0.9, 0.1],
+        }
+        embedder = Mock()
+        embedder.encode.side_effect = lambda texts, **kwargs: np.array([vectors[t] for t in texts])
+
+        agent1 = SubAgent("grant_researcher", "Research grants", [])
+        agent2 = SubAgent("compliance_checker", "Check compliance", [])
+
+        orchestrator = AgentOrchestrator(
+            [agent1, agent2], client=mock_claude_client, embedder=embedder
+        )
+
+        assert orchestrator.route_task("Find grants for EV charging") == "grant_researcher"
+        mock_claude_client.messages.create.assert_not_called()
+
+    def test_route_task_ambiguous_embedding_uses_claude(self, mock_claude_client):
+        """Test that an ambiguous embedding match falls back to Claude."""
+        np = pytest.importorskip("numpy")
+        vectors = {
+            "Research grants": [1.0, 0.0],
+            "Check compliance": [0.0, 1.0],
+            "Handle this": [0.7, 0.7],
+        }
+        embedder = Mock()
+        embedder.encode.side_effect = lambda texts, **kwargs: np.array([vectors[t] for t in texts])
+        mock_claude_client.messages.create.return_value = Mock(
+            content=[Mock(text="compliance_checker")]
+        )
+
+        agent1 = SubAgent("grant_researcher", "Research grants", [])
+        agent2 = SubAgent("compliance_checker", "Check compliance", [])
+
+        orchestrator = AgentOrchestrator(
+            [agent1, agent2], client=mock_claude_client, embedder=embedder
+        )
+
+        assert orchestrator.route_task("Handle this") == "compliance_checker"
+        mock_claude_client.messages.create.assert_called_once()
+
+    @patch('claude_agent_sdk.multi_agent_orchestration.get_embedder')
+    def test_route_task_embeddings_off_by_default(self, mock_get_embedder, mock_claude_client):
+        """Test that the shared embedding model is never loaded unless opted in."""
+        mock_claude_client.messages.create.return_value = Mock(content=[Mock(text="agent1")])
+
+        orchestrator = AgentOrchestrator([SubAgent("agent1", "role1", [])], client=mock_claude_client)
+
+        assert orchestrator.route_task("Some task") == "agent1"
+        mock_get_embedder.assert_not_called()
+
+    def test_execute_with_preferred_agent(self):
+        """Test execution with preferred agent bypasses routing."""
+        routing_client = Mock(spec=Anthropic)
+        agent_client = Mock(spec=Anthropic)
+        agent_client.messages.create.return_value = Mock(content="Done", usage=None)
+
+        agent1 = SubAgent("agent1", "role1", [], client=agent_client)
+        agent2 = SubAgent("agent2", "role2", [], client=agent_client)
+
+        orchestrator = AgentOrchestrator([agent1, agent2], client=routing_client)
 
         result = orchestrator.execute(
             "Task",
@@ -180,20 +264,24 @@ class TestAgentOrchestrator:
 
         assert result["agent"] == "agent2"
         # Routing should not have been called
-        mock_anthropic.return_value.messages.create.assert_not_called()
+        routing_client.messages.create.assert_not_called()
 
-    @patch('claude_agent_sdk.multi_agent_orchestration.SubAgent.execute')
-    @patch('claude_agent_sdk.multi_agent_orchestration.Anthropic')
-    def test_execute_pipeline(self, mock_anthropic, mock_execute):
-        """Test pipeline execution with context passing."""
-        # Mock successful executions
-        mock_execute.side_effect = [
-            {"success": True, "agent": "agent1", "result": "Step 1 done"},
-            {"success": True, "agent": "agent2", "result": "Step 2 done"},
-        ]
+    def test_execute_pipeline(self):
+        """Test that independent pipeline tasks run concurrently."""
+        timings = {}
 
-        agent1 = SubAgent("agent1", "role1", [])
-        agent2 = SubAgent("agent2", "role2", [])
+        async def fake_create(**kwargs):
+            task = kwargs["messages"][0]["content"]
+            start = time.perf_counter()
+            await asyncio.sleep(0.05)
+            timings[task] = (start, time.perf_counter())
+            return Mock(content=f"{task} done", usage=None)
+
+        async_client = Mock(spec=AsyncAnthropic)
+        async_client.messages.create = AsyncMock(side_effect=fake_create)
+
+        agent1 = SubAgent("agent1", "role1", [], async_client=async_client)
+        agent2 = SubAgent("agent2", "role2", [], async_client=async_client)
 
         orchestrator = AgentOrchestrator([agent1, agent2])
 
@@ -208,36 +296,171 @@ class TestAgentOrchestrator:
         assert results[0]["agent"] == "agent1"
         assert results[1]["agent"] == "agent2"
 
-    def test_execution_history_tracking(self):
-        """Test that execution history is tracked."""
-        agent = SubAgent("agent", "role", [])
+        # Independent tasks overlap: each starts before the other finishes
+        first_start, first_end = timings["First task"]
+        second_start, second_end = timings["Second task"]
+        assert second_start < first_end
+        assert first_start < second_end
+
+    def test_execute_pipeline_dependencies(self):
+        """Test that dependent tasks wait and receive upstream results as context."""
+        async_client = Mock(spec=AsyncAnthropic)
+        async_client.messages.create = AsyncMock(side_effect=[
+            Mock(content="Step 1 done", usage=None),
+            Mock(content="Step 2 done", usage=None),
+        ])
+
+        agent1 = SubAgent("agent1", "role1", [], async_client=async_client)
+        agent2 = SubAgent("agent2", "role2", [], async_client=async_client)
+
+        orchestrator = AgentOrchestrator([agent1, agent2])
+
+        tasks = [
+            {"description": "First task", "agent": "agent1"},
+            {"description": "Second task", "agent": "agent2", "depends_on": ["task_1"]},
+        ]
+
+        results = orchestrator.execute_pipeline(tasks)
+
+        assert [r["agent"] for r in results] == ["agent1", "agent2"]
+        first_system = async_client.messages.create.call_args_list[0].kwargs["system"]
+        second_system = async_client.messages.create.call_args_list[1].kwargs["system"]
+        assert "Context:" not in first_system
+        assert "Step 1 done" in second_system
+
+    def test_execute_pipeline_uses_sync_client(self, mock_claude_client):
+        """Test that pipelines honour an injected sync client."""
+        mock_claude_client.messages.create.return_value = Mock(
+            content="done", usage=None
+        )
+
+        agent = SubAgent("agent1", "role1", [], client=mock_claude_client)
         orchestrator = AgentOrchestrator([agent])
 
-        # Mock execute to avoid API calls
-        with patch.object(SubAgent, 'execute') as mock_execute:
-            mock_execute.return_value = {
-                "success": True,
-                "agent": "agent",
-                "result": "Done"
-            }
+        with patch.object(multi_agent_orchestration, "get_async_client") as get_async:
+            results = orchestrator.execute_pipeline([
+                {"description": "First task", "agent": "agent1"},
+            ])
+
+        assert results[0]["success"] is True
+        mock_claude_client.messages.create.assert_called_once()
+        get_async.assert_not_called()
+
+    def test_execute_pipeline_prefers_async_client(self, mock_claude_client):
+        """Test that pipelines use async_client when both clients are injected."""
+        async_client = Mock(spec=AsyncAnthropic)
+        async_client.messages.create = AsyncMock(
+            return_value=Mock(content="done", usage=None)
+        )
+
+        agent = SubAgent(
+            "agent1", "role1", [],
+            client=mock_claude_client, async_client=async_client
+        )
+        orchestrator = AgentOrchestrator([agent])
+
+        results = orchestrator.execute_pipeline([
+            {"description": "First task", "agent": "agent1"},
+        ])
+
+        assert results[0]["success"] is True
+        async_client.messages.create.assert_awaited_once()
+        mock_claude_client.messages.create.assert_not_called()
+
+    def test_execute_pipeline_uses_overridden_execute(self):
+        """Test that pipelines dispatch to a subclass's execute()."""
+        class StubAgent(SubAgent):
+            def execute(self, task, context=None):
+                return {"success": True, "agent": self.name, "result": task.upper()}
+
+        orchestrator = AgentOrchestrator([StubAgent("stub", "role", [])])
+
+        results = orchestrator.execute_pipeline([
+            {"description": "shout", "agent": "stub"},
+        ])
+
+        assert results[0]["result"] == "SHOUT"
+
+    @patch('claude_agent_sdk.multi_agent_orchestration.DefaultAsyncHttpxClient')
+    @patch('claude_agent_sdk.multi_agent_orchestration.AsyncAnthropic')
+    def test_sync_pipeline_closes_async_client(self, mock_async_anthropic, mock_http_client):
+        """Test that each sync pipeline run closes the async client it created."""
+        clients = []
+
+        def make_client(**kwargs):
+            client = Mock(spec=AsyncAnthropic)
+            client.messages.create = AsyncMock(return_value=Mock(content="Done", usage=None))
+            client.close = AsyncMock()
+            clients.append(client)
+            return client
+
+        mock_async_anthropic.side_effect = make_client
+
+        orchestrator = AgentOrchestrator([SubAgent("agent", "role", [])])
+        tasks = [{"description": "Task", "agent": "agent"}]
+
+        orchestrator.execute_pipeline(tasks)
+        orchestrator.execute_pipeline(tasks)
+
+        assert len(clients) == 2
+        for client in clients:
+            client.close.assert_awaited_once()
+        assert multi_agent_orchestration._async_client is None
+
+    def test_pipeline_rejects_dependency_cycle(self):
+        """Test that cyclic dependencies are reported instead of hanging."""
+        tasks = [
+            {"id": "a", "description": "A", "depends_on": ["b"]},
+            {"id": "b", "description": "B", "depends_on": ["a"]},
+        ]
+
+        with pytest.raises(ValueError):
+            AgentOrchestrator._pipeline_layers(tasks)
 
-            orchestrator.execute("Task 1")
-            orchestrator.execute("Task 2")
+    @pytest.mark.parametrize("tasks", [
+        [{"id": "a", "description": "A"}, {"id": "a", "description": "B"}],
+        [{"description": "A"}, {"id": "task_1", "description": "B"}],
+    ])
+    def test_pipeline_rejects_duplicate_ids(self, tasks):
+        """Test that explicit and default task ids must be unique."""
+        with pytest.raises(ValueError, match="Duplicate"):
+            AgentOrchestrator._pipeline_layers(tasks)
+
+    def test_execution_history_tracking(self, mock_claude_client):
+        """Test that execution history is tracked."""
+        mock_claude_client.messages.create.return_value = Mock(
+            content=[Mock(text="agent")], usage=None
+        )
+
+        agent = SubAgent("agent", "role", [], client=mock_claude_client)
+        orchestrator = AgentOrchestrator([agent], client=mock_claude_client)
+
+        orchestrator.execute("Task 1")
+        orchestrator.execute("Task 2")
 
         assert len(orchestrator.execution_history) == 2
         assert orchestrator.execution_history[0]["task"] == "Task 1"
         assert orchestrator.execution_history[1]["task"] == "Task 2"
 
+    def test_execution_history_is_bounded(self, mock_claude_client):
+        """Test that history keeps only the most recent entries."""
+        mock_claude_client.messages.create.return_value = Mock(content="Done", usage=None)
+
+        agent = SubAgent("agent", "role", [], client=mock_claude_client)
+        orchestrator = AgentOrchestrator([agent], history_limit=2)
+
+        for task in ["Task 1", "Task 2", "Task 3"]:
+            orchestrator.execute(task, preferred_agent="agent")
+
+        assert len(orchestrator.execution_history) == 2
+        assert [entry["task"] for entry in orchestrator.execution_history] == ["Task 2", "Task 3"]
+
 
 class TestIntegration:
     """Integration tests for complete workflows."""
 
-    @patch('claude_agent_sdk.multi_agent_orchestration.Anthropic')
-    def test_full_grant_research_workflow(self, mock_anthropic):
+    def test_full_grant_research_workflow(self, mock_claude_client):
         """Test complete grant research workflow."""
-        # Mock all API responses
-        mock_client = Mock()
-
         # Routing response
         routing_response = Mock()
         routing_response.content = [Mock(text="grant_researcher")]
@@ -247,20 +470,20 @@ class TestIntegration:
         task_response.content = [{"type": "text", "text": "Found 5 grants"}]
         task_response.usage = Mock(input_tokens=100, output_tokens=50)
 
-        mock_client.messages.create.side_effect = [
+        mock_claude_client.messages.create.side_effect = [
             routing_response,
             task_response
         ]
-        mock_anthropic.return_value = mock_client
 
         # Create agents
         researcher = SubAgent(
             "grant_researcher",
             "Search for grants",
-            [{"name": "search_grants"}]
+            [{"name": "search_grants"}],
+            client=mock_claude_client
         )
 
-        orchestrator = AgentOrchestrator([researcher])
+        orchestrator = AgentOrchestrator([researcher], client=mock_claude_client)
 
         # Execute task
         result = orchestrator.execute(
@@ -272,6 +495,18 @@ class TestIntegration:
 
 
 # Pytest fixtures
+@pytest.fixture(autouse=True)
+def reset_clients():
+    """Drop the shared clients so tests that patch Anthropic see the patch."""
+    multi_agent_orchestration._client = None
+    multi_agent_orchestration._async_client = None
+    multi_agent_orchestration._async_client_loop = None
+    yield
+    multi_agent_orchestration._client = None
+    multi_agent_orchestration._async_client = None
+    multi_agent_orchestration._async_client_loop = None
+
+
 @pytest.fixture
 def sample_tools():
     """Provide sample tool definitions for testing."""
@@ -292,11 +527,8 @@ def sample_tools():
 
 @pytest.fixture
 def mock_claude_client():
-    """Provide mocked Claude API client."""
-    with patch('claude_agent_sdk.multi_agent_orchestration.Anthropic') as mock:
-        client = Mock()
-        mock.return_value = client
-        yield client
+    """Provide a mocked Claude API client for injection into agents."""
+    return Mock(spec=Anthropic)
 
 
 # Run tests with: pytest test_orchestration.py -v
@@ -8,14 +8,21 @@ Demonstrates testing patterns for FastAPI WebSocket applications.
 import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, patch, AsyncMock
+from starlette.websockets import WebSocket
+import asyncio
 import json
-import sys
-import os
+import time
+from datetime import datetime
 
-# Add parent directory to path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from fastapi_patterns.websocket_streaming import app, ConnectionManager, manager, encode_message
 
-from fastapi_patterns.websocket_streaming import app, ConnectionManager, manager
+
+def _sent_types(mock_ws):
+    """Collect the "type" of every message passed to send_json."""
+    return {
+        (call.args[0] if call.args else call.kwargs.get("data", {})).get("type")
+        for call in mock_ws.send_json.call_args_list
+    }
 
 
 class TestConnectionManager:
@@ -46,6 +53,25 @@ class TestConnectionManager:
 
         assert "client1" not in connection_manager.active_connections
 
+    def test_connections_are_sharded(self, connection_manager):
+        """Test that clients spread across shards but look up like a dict."""
+        for i in range(64):
+            connection_manager.active_connections[f"client{i}"] = Mock()
+
+        shards = connection_manager.active_connections.shards
+        assert sum(1 for shard in shards if shard) > 1
+        assert len(connection_manager) == 64
+        assert "client42" in connection_manager.active_connections
+        assert set(connection_manager.active_connections) == {f"client{i}" for i in range(64)}
+
+    def test_reassigning_connections_to_itself_keeps_them(self, connection_manager):
+        """Test that assigning the current view back does not wipe it."""
+        connection_manager.active_connections["client1"] = Mock()
+
+        connection_manager.active_connections = connection_manager.active_connections
+
+        assert "client1" in connection_manager.active_connections
+
     @pytest.mark.asyncio
     async def test_send_message_to_specific_client(self, connection_manager):
         """Test sending message to specific client."""
@@ -55,7 +81,22 @@ class TestConnectionManager:
         message = {"type": "test", "content": "Hello"}
         await connection_manager.send_message("client1", message)
 
-        mock_websocket.send_json.assert_called_once_with(message)
+        mock_websocket.send_text.assert_called_once_with(encode_message(message))
+        assert json.loads(mock_websocket.send_text.call_args.args[0]) == message
+
+    @pytest.mark.parametrize("backend", ["orjson", "json"])
+    def test_encode_message_backends_agree(self, backend):
+        """Test that orjson and the stdlib fallback encode identically."""
+        if backend == "orjson":
+            orjson = pytest.importorskip("orjson")
+        else:
+            orjson = None
+
+        message = {1: "a", "at": datetime(2024, 1, 2, 3, 4, 5)}
+        with patch('fastapi_patterns.websocket_streaming.orjson', orjson):
+            encoded = encode_message(message)
+
+        assert encoded == '{"1":"a","at":"2024-01-02T03:04:05"}'
 
     @pytest.mark.asyncio
     async def test_broadcast_to_all_clients(self, connection_manager):
@@ -70,15 +111,40 @@ class TestConnectionManager:
         message = {"type": "broadcast", "content": "Everyone"}
         await connection_manager.broadcast(message)
 
-        mock_ws1.send_json.assert_called_once_with(message)
-        mock_ws2.send_json.assert_called_once_with(message)
+        mock_ws1.send_text.assert_called_once_with(encode_message(message))
+        mock_ws2.send_text.assert_called_once_with(encode_message(message))
+        # Encoded once: every client receives the very same payload object
+        assert mock_ws1.send_text.call_args.args[0] is mock_ws2.send_text.call_args.args[0]
+
+    @pytest.mark.asyncio
+    async def test_broadcast_sends_concurrently(self, connection_manager):
+        """Test that broadcast overlaps sends instead of awaiting each in turn."""
+        delay = 0.05
+
+        async def slow_send(message):
+            await asyncio.sleep(delay)
+
+        websockets = []
+        for i in range(8):
+            mock_ws = AsyncMock()
+            mock_ws.send_text.side_effect = slow_send
+            websockets.append(mock_ws)
+            connection_manager.active_connections[f"client{i}"] = mock_ws
+
+        start = time.perf_counter()
+        await connection_manager.broadcast({"type": "broadcast"})
+        elapsed = time.perf_counter() - start
+
+        assert elapsed < delay * len(websockets)
+        for mock_ws in websockets:
+            mock_ws.send_text.assert_awaited_once()
 
     @pytest.mark.asyncio
     async def test_broadcast_handles_disconnected_clients(self, connection_manager):
         """Test that broadcast removes clients that fail."""
         mock_ws1 = AsyncMock()
         mock_ws2 = AsyncMock()
-        mock_ws2.send_json.side_effect = Exception("Connection lost")
+        mock_ws2.send_text.side_effect = Exception("Connection lost")
 
         connection_manager.active_connections = {
             "client1": mock_ws1,
@@ -91,15 +157,74 @@ class TestConnectionManager:
         # Client2 should be removed after error
         assert "client2" not in connection_manager.active_connections
         assert "client1" in connection_manager.active_connections
+        mock_ws2.close.assert_awaited_once_with(code=1011)
+
+    @pytest.mark.asyncio
+    async def test_broadcast_keeps_reconnected_client(self):
+        """Test that dropping a slow socket doesn't remove the client's new one."""
+        connection_manager = ConnectionManager(send_timeout=0.05)
+        old_ws = AsyncMock()
+        new_ws = AsyncMock()
+
+        async def reconnect_then_hang(payload):
+            # The client reconnects while its old send is still pending
+            await connection_manager.connect(new_ws, "client1")
+            await asyncio.Event().wait()
+
+        old_ws.send_text.side_effect = reconnect_then_hang
+        connection_manager.active_connections["client1"] = old_ws
+
+        await connection_manager.broadcast({"type": "test"})
+
+        assert connection_manager.active_connections["client1"] is new_ws
+        old_ws.close.assert_awaited_once_with(code=1011)
+        new_ws.close.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_broadcast_drops_slow_clients(self):
+        """Test that a send that never completes is cancelled and its client removed."""
+        connection_manager = ConnectionManager(send_timeout=0.05)
+        hung_send = asyncio.get_running_loop().create_future()
+
+        mock_ws1 = AsyncMock()
+        mock_ws2 = AsyncMock()
+        mock_ws3 = AsyncMock()
+
+        async def hang(payload):
+            await hung_send
+
+        mock_ws3.send_text.side_effect = hang
+
+        connection_manager.active_connections = {
+            "client1": mock_ws1,
+            "client2": mock_ws2,
+            "client3": mock_ws3
+        }
+
+        start = time.perf_counter()
+        await connection_manager.broadcast({"type": "test"})
+        elapsed = time.perf_counter() - start
+
+        assert elapsed < 1.0
+        assert hung_send.cancelled()
+        assert "client3" not in connection_manager.active_connections
+        assert "client1" in connection_manager.active_connections
+        assert "client2" in connection_manager.active_connections
+
+        # The slow socket is closed, not just forgotten
+        mock_ws3.close.assert_awaited_once_with(code=1011)
+        mock_ws1.close.assert_not_called()
+        mock_ws2.close.assert_not_called()
 
 
 class TestWebSocketEndpoints:
     """Test suite for WebSocket endpoints."""
 
-    @pytest.fixture
-    def client(self):
-        """Provide FastAPI TestClient."""
-        return TestClient(app)
+    @pytest.fixture(scope="module")
+    def ws_conn(self, client):
+        """Provide one WebSocket connection shared by the endpoint tests."""
+        with client.websocket_connect("/ws/agent/shared_client") as websocket:
+            yield websocket
 
     def test_health_check_endpoint(self, client):
         """Test /health endpoint returns correct status."""
@@ -111,159 +236,149 @@ class TestWebSocketEndpoints:
         assert "active_connections" in data
         assert "timestamp" in data
 
-    @pytest.mark.asyncio
-    async def test_websocket_connection_lifecycle(self, client):
+    def test_websocket_connection_lifecycle(self, client):
         """Test WebSocket connection and disconnection."""
-        with patch('fastapi_patterns.websocket_streaming.stream_agent_response') as mock_stream:
-            mock_stream.return_value = None
-
-            with client.websocket_connect("/ws/agent/test_client") as websocket:
-                # Connection should be established
-                assert "test_client" in manager.active_connections
+        with client.websocket_connect("/ws/agent/test_client") as websocket:
+            # Connection should be established
+            assert "test_client" in manager.active_connections
 
-            # After context exit, client should be disconnected
-            assert "test_client" not in manager.active_connections
+        # After context exit, client should be disconnected
+        assert "test_client" not in manager.active_connections
 
-    @pytest.mark.asyncio
-    async def test_websocket_message_handling(self, client):
+    @pytest.mark.leaks_connections
+    def test_websocket_message_handling(self, ws_conn):
         """Test WebSocket handles user messages."""
         with patch('fastapi_patterns.websocket_streaming.stream_agent_response') as mock_stream:
-            mock_stream.return_value = None
-
-            with client.websocket_connect("/ws/agent/test_client") as websocket:
-                # Send message
-                websocket.send_json({
-                    "type": "message",
-                    "content": "Hello agent",
-                    "context": {"user_id": "123"}
-                })
-
-                # stream_agent_response should be called
-                mock_stream.assert_called_once()
+            # Send message
+            ws_conn.send_json({
+                "type": "message",
+                "content": "Hello agent",
+                "context": {"user_id": "123"}
+            })
+
+            # Round-trip a ping so the message has been handled server-side
+            ws_conn.send_json({"type": "ping"})
+            assert ws_conn.receive_json()["type"] == "pong"
+
+            # stream_agent_response should be called
+            mock_stream.assert_called_once()
 
-    @pytest.mark.asyncio
-    async def test_websocket_ping_pong(self, client):
+    @pytest.mark.leaks_connections
+    def test_websocket_ping_pong(self, ws_conn):
         """Test WebSocket responds to ping with pong."""
-        with client.websocket_connect("/ws/agent/test_client") as websocket:
-            # Send ping
-            websocket.send_json({"type": "ping"})
+        # Send ping
+        ws_conn.send_json({"type": "ping"})
 
-            # Should receive pong
-            response = websocket.receive_json()
-            assert response["type"] == "pong"
+        # Should receive pong
+        response = ws_conn.receive_json()
+        assert response["type"] == "pong"
 
 
 class TestStreamingLogic:
     """Test suite for agent response streaming."""
 
     @pytest.mark.asyncio
-    async def test_stream_start_message(self):
+    async def test_stream_start_message(self, ws_mock, mock_claude_stream):
         """Test that streaming starts with start indicator."""
         from fastapi_patterns.websocket_streaming import stream_agent_response
 
-        mock_websocket = AsyncMock()
+        await stream_agent_response(
+            ws_mock,
+            "client1",
+            "Test message"
+        )
 
-        with patch('fastapi_patterns.websocket_streaming.client.messages.stream') as mock_stream:
-            # Mock the stream context manager
-            mock_stream_instance = Mock()
-            mock_stream_instance.__enter__ = Mock(return_value=mock_stream_instance)
-            mock_stream_instance.__exit__ = Mock(return_value=None)
-            mock_stream_instance.text_stream = []
-            mock_stream_instance.get_final_message.return_value = Mock(
-                usage=Mock(input_tokens=10, output_tokens=20)
-            )
-            mock_stream.return_value = mock_stream_instance
-
-            await stream_agent_response(
-                mock_websocket,
-                "client1",
-                "Test message"
-            )
-
-            # Check that start message was sent
-            calls = mock_websocket.send_json.call_args_list
-            assert any("message_start" in str(call) for call in calls)
+        # Check that start message was sent
+        assert "message_start" in _sent_types(ws_mock)
 
     @pytest.mark.asyncio
-    async def test_stream_completion_message(self):
+    @pytest.mark.parametrize("mock_claude_stream", [["Hello", " wor", "ld"]], indirect=True)
+    async def test_stream_completion_message(self, ws_mock, mock_claude_stream):
         """Test that streaming ends with completion message."""
         from fastapi_patterns.websocket_streaming import stream_agent_response
 
-        mock_websocket = AsyncMock()
+        await stream_agent_response(
+            ws_mock,
+            "client1",
+            "Test"
+        )
 
-        with patch('fastapi_patterns.websocket_streaming.client.messages.stream') as mock_stream:
-            mock_stream_instance = Mock()
-            mock_stream_instance.__enter__ = Mock(return_value=mock_stream_instance)
-            mock_stream_instance.__exit__ = Mock(return_value=None)
-            mock_stream_instance.text_stream = ["Hello", " world"]
-            mock_stream_instance.get_final_message.return_value = Mock(
-                usage=Mock(input_tokens=10, output_tokens=20)
-            )
-            mock_stream.return_value = mock_stream_instance
+        # Check that completion message was sent
+        assert "message_complete" in _sent_types(ws_mock)
 
-            await stream_agent_response(
-                mock_websocket,
-                "client1",
-                "Test"
-            )
+        # Deltas are coalesced into fewer frames without losing text
+        assert ws_mock.send_text.call_count <= 2
+        frames = [json.loads(c.args[0]) for c in ws_mock.send_text.call_args_list]
+        assert all(f["type"] == "content_delta" for f in frames)
+        assert "".join(f["content"] for f in frames) == "Hello world"
+
+    @pytest.mark.asyncio
+    async def test_coalescer_flushes_on_timer(self, ws_mock):
+        """Test that buffered text is sent after flush_ms without another push."""
+        from fastapi_patterns.websocket_streaming import _Coalescer
 
-            # Check that completion message was sent
-            calls = mock_websocket.send_json.call_args_list
-            assert any("message_complete" in str(call) for call in calls)
+        coalescer = _Coalescer(ws_mock, flush_ms=10)
+        await coalescer.push("Hello")
+        ws_mock.send_text.assert_not_called()
+
+        await asyncio.sleep(0.05)
+
+        ws_mock.send_text.assert_called_once()
+        assert json.loads(ws_mock.send_text.call_args.args[0])["content"] == "Hello"
 
     @pytest.mark.asyncio
-    async def test_stream_error_handling(self):
+    async def test_coalescer_reraises_timer_send_error(self, ws_mock):
+        """Test that a failed timer flush surfaces on the next push."""
+        from fastapi_patterns.websocket_streaming import _Coalescer
+
+        ws_mock.send_text.side_effect = RuntimeError("socket closed")
+
+        coalescer = _Coalescer(ws_mock, flush_ms=10)
+        await coalescer.push("Hello")
+        await asyncio.sleep(0.05)
+
+        with pytest.raises(RuntimeError, match="socket closed"):
+            await coalescer.push(" world")
+
+    @pytest.mark.asyncio
+    async def test_stream_error_handling(self, ws_mock):
         """Test that streaming errors are caught and sent to client."""
         from fastapi_patterns.websocket_streaming import stream_agent_response
 
-        mock_websocket = AsyncMock()
-
-        with patch('fastapi_patterns.websocket_streaming.client.messages.stream') as mock_stream:
+        with patch('fastapi_patterns.websocket_streaming.async_client.messages.stream') as mock_stream:
             mock_stream.side_effect = Exception("API Error")
 
             await stream_agent_response(
-                mock_websocket,
+                ws_mock,
                 "client1",
                 "Test"
             )
 
             # Check that error message was sent
-            calls = mock_websocket.send_json.call_args_list
-            error_calls = [call for call in calls if "error" in str(call)]
-            assert len(error_calls) > 0
+            assert "error" in _sent_types(ws_mock)
 
     @pytest.mark.asyncio
-    async def test_stream_with_context(self):
+    async def test_stream_with_context(self, ws_mock, mock_claude_stream):
         """Test streaming with context data."""
         from fastapi_patterns.websocket_streaming import stream_agent_response
 
-        mock_websocket = AsyncMock()
+        mock_stream = mock_claude_stream
         context = {
             "user_id": "123",
             "preferences": {"theme": "dark"}
         }
 
-        with patch('fastapi_patterns.websocket_streaming.client.messages.stream') as mock_stream:
-            mock_stream_instance = Mock()
-            mock_stream_instance.__enter__ = Mock(return_value=mock_stream_instance)
-            mock_stream_instance.__exit__ = Mock(return_value=None)
-            mock_stream_instance.text_stream = []
-            mock_stream_instance.get_final_message.return_value = Mock(
-                usage=Mock(input_tokens=10, output_tokens=20)
-            )
-            mock_stream.return_value = mock_stream_instance
+        await stream_agent_response(
+            ws_mock,
+            "client1",
+            "Test message",
+            context=context
+        )
 
-            await stream_agent_response(
-                mock_websocket,
-                "client1",
-                "Test message",
-                context=context
-            )
-
-            # Verify stream was called with context in system prompt
-            mock_stream.assert_called_once()
-            call_kwargs = mock_stream.call_args[1]
-            assert "Context:" in call_kwargs["system"]
+        # Verify stream was called with context in system prompt
+        mock_stream.assert_called_once()
+        call_kwargs = mock_stream.call_args[1]
+        assert "Context:" in call_kwargs["system"]
 
 
 class TestProduction:
@@ -301,12 +416,32 @@ class TestProduction:
 
 
 # Pytest configuration
+@pytest.fixture(scope="session")
+def client():
+    """Provide one FastAPI TestClient for the whole test session."""
+    return TestClient(app)
+
+
+@pytest.fixture
+def ws_mock():
+    """Provide a WebSocket mock restricted to the real WebSocket API."""
+    return AsyncMock(spec=WebSocket)
+
+
 @pytest.fixture(autouse=True)
-def reset_manager():
-    """Reset connection manager before each test."""
-    manager.active_connections.clear()
+def reset_manager(request):
+    """
+    Reset connection manager after each test.
+
+    Every test must leave the manager empty, so clearing once afterwards
+    is enough. Connections still registered at teardown fail the test
+    unless it is marked @pytest.mark.leaks_connections.
+    """
     yield
+    leaked = list(manager.active_connections)
     manager.active_connections.clear()
+    if leaked and request.node.get_closest_marker("leaks_connections") is None:
+        pytest.fail(f"Test left connections registered: {leaked}")
 
 
 # Run with: pytest test_websocket.py -v --asyncio-mode=auto